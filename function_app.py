@@ -1,13 +1,19 @@
 import azure.functions as func
 import logging
-import requests
+import asyncio
+import aiohttp
 import os
-import json
+import time
+import hashlib
+import gzip
+from urllib.parse import quote
+import orjson
 from datetime import datetime, timedelta
 import smtplib
 from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from azure.storage.blob import BlobServiceClient
+from azure.storage.blob import ContentSettings
+from azure.storage.blob.aio import BlobServiceClient
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
 import azure.core.pipeline.policies as policies
 
 
@@ -16,232 +22,365 @@ logging.getLogger('azure.core.pipeline.policies.http_logging_policy').setLevel(l
 logging.getLogger('azure').setLevel(logging.WARNING)
 logging.getLogger('azure.storage.blob').setLevel(logging.WARNING)
 
+_log = logging.getLogger(__name__)
+
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
+def _resolve_conn_str():
+    connection_string = os.environ.get("AZURE_STORAGE_CONNECTION_STRING")
+    if connection_string == "UseDevelopmentStorage=true":
+        connection_string = "DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;AccountKey=Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw==;BlobEndpoint=http://127.0.0.1:10000/devstoreaccount1;"
+    return connection_string
+
+# config is read once per worker rather than on every call
+_MAPS_KEY = os.environ.get("AZURE_MAPS_KEY", "")
+_CONN_STR = _resolve_conn_str()
+
+# only the coords change between maps calls so the rest of the url is fixed
+_URL_TEMPLATE = (
+    "https://atlas.microsoft.com/weather/forecast/daily/json"
+    "?api-version=1.1&duration=1"  # 1 day forecast
+    "&subscription-key=" + quote(_MAPS_KEY, safe="") + "&query={q}"
+)
+
+# local/ POI coords, already in the lat,lon format azure maps wants
+_LOCATIONS = (
+    ("Leeds", "53.800800,-1.549100"),
+    ("London", "51.507400,-0.127800"),
+)
+
+# section separators for the email
+_THICK_RULE = "=" * 40 + "\n"
+_THIN_RULE = "-" * 40 + "\n"
+
+# http session for azure maps, built once per worker; locations in a run share
+# its connection pool (idle connections don't outlive the hour between runs)
+_http = None
+
+def _get_http():
+    global _http
+    if _http is None or _http.closed:
+        _http = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=16, ttl_dns_cache=300),
+            # a stuck maps call shouldn't hang the whole invocation, total caps
+            # slow trickling responses and connect covers dns + pool waits
+            timeout=aiohttp.ClientTimeout(total=15, connect=5, sock_connect=3, sock_read=10),
+        )
+    return _http
+
 # get weather data every hour and store it
 @app.schedule(schedule="0 0 * * * *", arg_name="timer", run_on_startup=True)
-def fetch_and_store_weather(timer: func.TimerRequest) -> None:
-    logging.info('starting hourly weather data collection')
+async def fetch_and_store_weather(timer: func.TimerRequest) -> None:
+    _log.info('starting hourly weather data collection')
     
     try:
-        # local/ POI coords
-        locations = [
-            {"name": "Leeds", "lat": 53.8008, "lon": -1.5491},
-            {"name": "London", "lat": 51.5074, "lon": -0.1278},
-        ]
+        session = _get_http()
+        
+        # fetch all locations at once rather than one after another,
+        # one failing location shouldn't lose the others
+        results = await asyncio.gather(
+            *[_fetch_location(session, name, coord_query) for name, coord_query in _LOCATIONS],
+            return_exceptions=True
+        )
         
         all_weather_data = []
+        for (name, _), result in zip(_LOCATIONS, results):
+            # cancelled children come back as CancelledError, a BaseException
+            if isinstance(result, BaseException):
+                _log.error('failed to get weather for %s: %r', name, result)
+            elif result is not None:
+                all_weather_data.append(result)
         
-        for location in locations:
-            # need lat,lon format for azure maps api
-            coord_query = f"{location['lat']:.6f},{location['lon']:.6f}"
-            
-            key = os.environ["AZURE_MAPS_KEY"]
-            url = "https://atlas.microsoft.com/weather/forecast/daily/json"
-            params = {
-                'api-version': '1.1',
-                'query': coord_query,
-                'duration': 1,  # 1 day forecast
-                'subscription-key': key
-            }
-
-            logging.info(f'getting weather for {location["name"]}')
-            response = requests.get(url, params=params)
-            
-            if response.status_code != 200:
-                logging.error(f'api error for {location["name"]}: {response.status_code} - {response.text}')
-                continue
-                
-            raw_data = response.json()
-            location_data = format_weather_data(raw_data, location["name"])
-            all_weather_data.append(location_data)
-            
-            # save city data
-            store_weather_data(location_data, location["name"])
+        # don't clobber today's blob with nothing
+        if not all_weather_data:
+            _log.error('no weather data fetched, keeping stored data')
+            return
         
-        # save combined data for email
-        store_weather_data({'locations': all_weather_data}, 'combined')
-        logging.info('weather data updated')
+        # on a partial fetch keep whatever today's blob already has for the
+        # locations we missed, and replace only the ones we got
+        if len(all_weather_data) < len(_LOCATIONS):
+            stored = await _read_weather_blob(f"combined/{_today()}.json")
+            if stored:
+                merged = {data['location']: data for data in stored.get('locations', [])}
+                merged.update({data['location']: data for data in all_weather_data})
+                all_weather_data = list(merged.values())
+        
+        # only the combined doc is read back, so write just that one blob
+        await store_weather_data({'locations': all_weather_data}, 'combined')
+        _log.info('weather data updated')
         
     except Exception as e:
-        logging.error(f'error getting weather: {str(e)}')
+        _log.error('error getting weather: %r', e)
+
+async def _fetch_location(session, name, coord_query):
+    _log.info('getting weather for %s', name)
+    async with session.get(_URL_TEMPLATE.format(q=coord_query)) as response:
+        if response.status != 200:
+            _log.error('api error for %s: %s - %s', name, response.status, await response.text())
+            return None
+        raw_data = await response.json(loads=orjson.loads)
+    
+    return format_weather_data(raw_data, name)
+
+def _format_day(day):
+    temperature = day['temperature']
+    day_summary = {
+        # api dates are already YYYY-MM-DDThh:mm:ss+zz so no need to parse them
+        'date': day['date'][:10],
+        'temp_range': f"{temperature['minimum']['value']:.1f}°C to {temperature['maximum']['value']:.1f}°C",
+        'day': {}
+    }
+    
+    day_data = day.get('day')
+    if day_data is not None:
+        day_info = {
+            'description': day_data['shortPhrase'],
+            'rain_chance': day_data['precipitationProbability'],
+            'feels_like': day_data.get('realFeelTemperature', {}).get('value')
+        }
+        
+        # only include wind if it's significant
+        wind = day_data.get('wind')
+        if wind is not None:
+            wind_speed = wind['speed']['value']
+            if wind_speed > 15:
+                day_info['wind'] = {
+                    'speed': wind_speed,
+                    'direction': wind['direction']['localizedDescription']
+                }
+        day_summary['day'] = day_info
+    
+    night = day.get('night')
+    if night is not None:
+        day_summary['night'] = {
+            'description': night['shortPhrase']
+        }
+    
+    return day_summary
 
 def format_weather_data(raw_data, location_name):
     # clean up the raw api data into something nice
-    formatted_data = {
+    return {
         'location': location_name,
-        'forecasts': []
+        'forecasts': [_format_day(day) for day in raw_data['forecasts']]
     }
+
+# storage clients are built once per worker and reused by warm invocations
+_blob_service = None
+_container = None
+_container_exists = False
+
+async def _get_container():
+    global _blob_service, _container, _container_exists
+    if _container is None:
+        _blob_service = BlobServiceClient.from_connection_string(_CONN_STR)
+        _container = _blob_service.get_container_client("weather-history")
     
-    for day in raw_data['forecasts']:
-        date = datetime.fromisoformat(day['date'].replace('Z', '+00:00')).strftime('%Y-%m-%d')
-        min_temp = day['temperature']['minimum']['value']
-        max_temp = day['temperature']['maximum']['value']
-        
-        day_info = {}
-        if 'day' in day:
-            day_data = day['day']
-            day_info = {
-                'description': day_data['shortPhrase'],
-                'rain_chance': day_data['precipitationProbability'],
-                'feels_like': day_data.get('realFeelTemperature', {}).get('value', None)
-            }
-            
-            # only include wind if it's significant
-            if 'wind' in day_data:
-                wind_speed = day_data['wind']['speed']['value']
-                if wind_speed > 15:
-                    day_info['wind'] = {
-                        'speed': wind_speed,
-                        'direction': day_data['wind']['direction']['localizedDescription']
-                    }
-        
-        day_summary = {
-            'date': date,
-            'temp_range': f"{min_temp:.1f}°C to {max_temp:.1f}°C",
-            'day': day_info
-        }
-        
-        if 'night' in day:
-            day_summary['night'] = {
-                'description': day['night']['shortPhrase']
-            }
-        
-        formatted_data['forecasts'].append(day_summary)
+    # create container the first time only
+    if not _container_exists:
+        try:
+            await _container.create_container()
+        except ResourceExistsError:
+            pass
+        _container_exists = True
     
-    return formatted_data
+    return _container
+
+# today's date string, only rebuilt once it rolls over at midnight
+_date_cache = {'date': None, 'expires': 0}
 
-def store_weather_data(weather_data, location_name):
+def _today():
+    if time.time() >= _date_cache['expires']:
+        now = datetime.now()
+        midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+        _date_cache['date'] = now.strftime("%Y-%m-%d")
+        _date_cache['expires'] = midnight.timestamp()
+    return _date_cache['date']
+
+# recently written/read blobs, keyed by blob name -> (cached at, data)
+_CACHE_TTL = 3600
+_weather_cache = {}
+
+def _cache_get(blob_name):
+    entry = _weather_cache.get(blob_name)
+    if entry and time.monotonic() - entry[0] < _CACHE_TTL:
+        return entry[1]
+    return None
+
+def _cache_put(blob_name, data):
+    now = time.monotonic()
+    # drop anything stale so old days don't pile up
+    for name in [n for n, (ts, _) in _weather_cache.items() if now - ts >= _CACHE_TTL]:
+        del _weather_cache[name]
+    _weather_cache[blob_name] = (now, data)
+
+# weather blobs are stored as gzipped json
+_JSON_GZIP = ContentSettings(content_type='application/json', content_encoding='gzip')
+_GZIP_MAGIC = b'\x1f\x8b'
+
+# location -> (blob name, payload hash) of the last successful write
+_last_hash = {}
+
+async def store_weather_data(weather_data, location_name):
     # save to azure blob storage
     try:
-        connection_string = os.environ.get("AZURE_STORAGE_CONNECTION_STRING")
-        if connection_string == "UseDevelopmentStorage=true":
-            connection_string = "DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;AccountKey=Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw==;BlobEndpoint=http://127.0.0.1:10000/devstoreaccount1;"
+        current_date = _today()
+        blob_name = f"{location_name}/{current_date}.json"
         
-        blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-        container_client = blob_service_client.get_container_client("weather-history")
+        payload = orjson.dumps(weather_data)
         
-        # create container if it doesn't exist
-        try:
-            container_client.get_container_properties()
-        except Exception:
-            container_client.create_container()
-        
-        current_date = datetime.now().strftime("%Y-%m-%d")
-        blob_name = f"{location_name}/{current_date}.json"
+        # forecasts rarely change hour to hour, skip the write if nothing did
+        last_write = (blob_name, hashlib.blake2b(payload, digest_size=16).digest())
+        if _last_hash.get(location_name) == last_write:
+            _log.info("weather data for %s unchanged, skipping upload", location_name)
+            _cache_put(blob_name, weather_data)
+            return True
         
+        # small enough for a single put blob, no need for stage/commit
+        body = gzip.compress(payload, mtime=0)
+        container_client = await _get_container()
         blob_client = container_client.get_blob_client(blob_name)
-        blob_client.upload_blob(json.dumps(weather_data), overwrite=True)
+        await blob_client.upload_blob(
+            body,
+            overwrite=True,
+            content_settings=_JSON_GZIP,
+            length=len(body),
+            max_concurrency=1
+        )
+        _last_hash[location_name] = last_write
+        _cache_put(blob_name, weather_data)
         
-        logging.info(f"saved weather data for {location_name}")
+        _log.info("saved weather data for %s", location_name)
         return True
         
     except Exception as e:
-        logging.error(f"failed to save data: {str(e)}")
+        _log.error("failed to save data: %s", e)
         return False
 
-def get_stored_weather_data():
-    # get data from storage for emails
+async def _read_weather_blob(blob_name):
+    # skip the download if we already have the data
+    cached = _cache_get(blob_name)
+    if cached is not None:
+        return cached
+    
+    # just try the download, a missing blob raises instead of needing exists()
+    container_client = await _get_container()
+    blob_client = container_client.get_blob_client(blob_name)
     try:
-        connection_string = os.environ.get("AZURE_STORAGE_CONNECTION_STRING")
-        if connection_string == "UseDevelopmentStorage=true":
-            connection_string = "DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;AccountKey=Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw==;BlobEndpoint=http://127.0.0.1:10000/devstoreaccount1;"
-        
-        blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-        container_client = blob_service_client.get_container_client("weather-history")
-        
-        # check if container exists
-        try:
-            container_client.get_container_properties()
-        except Exception as e:
-            logging.error(f"Container doesn't exist: {str(e)}")
-            return None
-            
-        current_date = datetime.now().strftime("%Y-%m-%d")
-        blob_name = f"combined/{current_date}.json"
+        downloaded_blob = await blob_client.download_blob()
+        blob_data = await downloaded_blob.readall()
+    except ResourceNotFoundError:
+        return None
+    if not blob_data:
+        raise ValueError(f"blob {blob_name} is empty")
         
-        # check if blob exists before trying to download
-        blob_client = container_client.get_blob_client(blob_name)
-        if not blob_client.exists():
-            logging.error(f"Blob {blob_name} not found")
-            return None
-            
-        # download and decode blob data
-        downloaded_blob = blob_client.download_blob()
-        blob_data = downloaded_blob.readall()
-        if not blob_data:
-            logging.error("Downloaded blob is empty")
-            return None
-            
-        # cecode and parse JSON
-        json_data = json.loads(blob_data.decode('utf-8'))
+    # the transport may already have undone the gzip encoding, and older
+    # blobs were written as plain json
+    if blob_data[:2] == _GZIP_MAGIC:
+        blob_data = gzip.decompress(blob_data)
+    
+    # parse JSON straight from the bytes
+    json_data = orjson.loads(blob_data)
+    _cache_put(blob_name, json_data)
+    return json_data
+
+async def get_stored_weather_data():
+    # get data from storage for emails
+    try:
+        blob_name = f"combined/{_today()}.json"
+        json_data = await _read_weather_blob(blob_name)
+        if json_data is None:
+            _log.error("Blob %s not found", blob_name)
         return json_data
         
     except Exception as e:
-        logging.error(f"couldn't get weather data: {str(e)}")
+        _log.error("couldn't get weather data: %s", e)
         return None
 
+# wake the worker just before the email so 7am doesn't pay for a cold start
+@app.schedule(schedule="0 55 6 * * *", arg_name="timer", run_on_startup=False)
+async def warm_up_for_email(timer: func.TimerRequest) -> None:
+    _log.info('warming up for daily email')
+    
+    try:
+        # open the storage client the email will reuse, smtp is left to the
+        # email itself since gmail would just idle the session out
+        await _get_container()
+    except Exception as e:
+        _log.error('warm up failed: %s', e)
+
 # send weather email at 7am
 @app.schedule(schedule="0 0 7 * * *", arg_name="timer", run_on_startup=False)
 # @app.schedule(schedule="*/5 * * * * *", arg_name="timer", run_on_startup=True)
-def send_weather_email(timer: func.TimerRequest) -> None:
-    logging.info('preparing daily weather email')
+async def send_weather_email(timer: func.TimerRequest) -> None:
+    _log.info('preparing daily weather email')
     
     try:
-        weather_data = get_stored_weather_data()
+        weather_data = await get_stored_weather_data()
         
         if weather_data and 'locations' in weather_data:
             email_body = create_email_content(weather_data['locations'])
-            send_formatted_email(email_body)
-            logging.info('\033[1;92memail sent successfully!\033[0m')
+            # smtplib blocks, keep it off the shared event loop
+            await asyncio.to_thread(send_formatted_email, email_body)
+            _log.info('\033[1;92memail sent successfully!\033[0m')
         else:
             raise Exception("no weather data for email")
             
     except Exception as e:
-        logging.error(f'failed to send email: {str(e)}')
+        _log.error('failed to send email: %s', e)
 
 def create_email_content(weather_data):
     # make email with emojis and alerts
-    email_body = "🌤️ Daily Weather Report 🌤️\n\n"
+    parts = ["🌤️ Daily Weather Report 🌤️\n\n"]
     
     for location_data in weather_data:
-        email_body += f"\n📍 {location_data['location'].upper()}\n"
-        email_body += "=" * 40 + "\n"
+        parts.append(f"\n📍 {location_data['location'].upper()}\n")
+        parts.append(_THICK_RULE)
         
         for day in location_data['forecasts']:
-            email_body += f"\n📅 {day['date']}\n"
-            email_body += f"🌡️ Temperature: {day['temp_range']}\n"
+            parts.append(f"\n📅 {day['date']}\n")
+            parts.append(f"🌡️ Temperature: {day['temp_range']}\n")
             
             if 'day' in day:
                 day_info = day['day']
-                email_body += f"☀️ Day: {day_info['description']}\n"
-                email_body += f"🌧️ Rain chance: {day_info['rain_chance']}%\n"
+                parts.append(f"☀️ Day: {day_info['description']}\n")
+                parts.append(f"🌧️ Rain chance: {day_info['rain_chance']}%\n")
                 
                 if day_info['rain_chance'] > 70:
-                    email_body += "⚠️ High chance of rain - bring an umbrella!\n"
+                    parts.append("⚠️ High chance of rain - bring an umbrella!\n")
                 
                 if 'feels_like' in day_info and day_info['feels_like']:
-                    email_body += f"🌡️ Feels like: {day_info['feels_like']}°C\n"
+                    parts.append(f"🌡️ Feels like: {day_info['feels_like']}°C\n")
                 
                 if 'wind' in day_info:
-                    email_body += f"💨 Wind: {day_info['wind']['speed']} km/h {day_info['wind']['direction']}\n"
+                    parts.append(f"💨 Wind: {day_info['wind']['speed']} km/h {day_info['wind']['direction']}\n")
             
             if 'night' in day:
-                email_body += f"🌙 Night: {day['night']['description']}\n"
+                parts.append(f"🌙 Night: {day['night']['description']}\n")
             
-            email_body += "-" * 40 + "\n"
+            parts.append(_THIN_RULE)
     
-    return email_body
+    return "".join(parts)
+
+# email headers never change between sends
+_MSG_FROM = os.environ.get("GMAIL_USER")
+_MSG_TO = os.environ.get("TO_EMAIL")
+_SUBJECT = '🌤️ Your Daily Weather Report'
 
 def send_formatted_email(email_body):
+    # headers are read at import, so say which setting is missing rather than
+    # failing later with a None header/login
+    if not _MSG_FROM or not _MSG_TO:
+        raise ValueError("GMAIL_USER and TO_EMAIL must be set to send email")
+    
     # send via gmail
-    msg = MIMEMultipart()
-    msg['From'] = os.environ["GMAIL_USER"]
-    msg['To'] = os.environ["TO_EMAIL"]
-    msg['Subject'] = '🌤️ Your Daily Weather Report'
-    msg.attach(MIMEText(email_body, 'plain'))
+    # single plain text part, no need for a multipart wrapper
+    msg = MIMEText(email_body, 'plain', 'utf-8')
+    msg['From'] = _MSG_FROM
+    msg['To'] = _MSG_TO
+    msg['Subject'] = _SUBJECT
     
-    with smtplib.SMTP('smtp.gmail.com', 587) as server:
-        server.starttls()
-        server.login(os.environ["GMAIL_USER"], os.environ["GMAIL_APP_PASSWORD"])
+    # implicit tls on 465 saves the starttls round trips
+    with smtplib.SMTP_SSL('smtp.gmail.com', 465, timeout=10) as server:
+        server.login(_MSG_FROM, os.environ["GMAIL_APP_PASSWORD"])
         server.send_message(msg)
\ No newline at end of file